@@ -3,17 +3,110 @@
 ##### Uniqname: kayleegs
 #################################
 
-from bs4 import BeautifulSoup
-import requests
-import json
+from bs4 import BeautifulSoup, SoupStrainer
+from lxml import etree
+import lxml.html
+import aiohttp
+import asyncio
+import atexit
+import functools
+import orjson
+import sqlite3
+import sys
+import zstandard as zstd
 import secrets # file that contains your API key
 
-CACHE_FILENAME = "cache.json"
+CACHE_FILENAME = "cache.db"
+# bump whenever the format of stored values changes; older caches are discarded
+CACHE_VERSION = 4
+MAX_CONNECTIONS = 32
+# times a request is retried after a connection error
+MAX_RETRIES = 3
+
+# one event loop and one client session for the whole run, so connections
+# (and TLS handshakes) to nps.gov and mapquestapi.com are reused across calls.
+# The session is created by run() the first time it is needed
+LOOP = asyncio.new_event_loop()
+SESSION = None
+
+# XPath expressions for the parts of nps.gov pages we read, compiled once.
+# Each selects the text of the first matching element, like soup.find(...).contents[0]
+def _has_class(name):
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+STATE_LINKS_XPATH = etree.XPath('(//ul[@class="dropdown-menu SearchBar-keywordSearch"])[1]//a')
+CATEGORY_XPATH = etree.XPath(
+    f'(//*[{_has_class("Hero-designationContainer")}]//span[{_has_class("Hero-designation")}])[1]/text()',
+    smart_strings=False)
+NAME_XPATH = etree.XPath('(//*[@class="Hero-titleContainer clearfix"]//a)[1]/text()', smart_strings=False)
+CITY_XPATH = etree.XPath('(//span[@itemprop="addressLocality"])[1]/text()', smart_strings=False)
+STATE_XPATH = etree.XPath('(//span[@itemprop="addressRegion"])[1]/text()', smart_strings=False)
+ZIPCODE_XPATH = etree.XPath('(//span[@itemprop="postalCode"])[1]/text()', smart_strings=False)
+PHONE_XPATH = etree.XPath('(//span[@itemprop="telephone"])[1]/text()', smart_strings=False)
+
+# only the list of sites is built into a tree when parsing a state page
+PARK_LIST_STRAINER = SoupStrainer(id='parkListResultsArea')
+
+class Cache:
+    '''a persistent cache stored in an SQLite database
+
+    Each key (a URL, a zipcode or 'states') is its own row, so adding an
+    entry only writes that entry instead of rewriting the whole cache.
+    Values are stored as orjson-encoded blobs compressed with zstd.
+
+    Writes are not committed until save_cache is called, so a run of
+    inserts costs a single commit.
+
+    Instance Attributes
+    -------------------
+    conn: sqlite3.Connection
+        the connection to the cache database
+
+    dirty: bool
+        whether there are writes that have not been saved yet
+
+    compressor: zstd.ZstdCompressor
+        compresses values before they are stored
+
+    decompressor: zstd.ZstdDecompressor
+        decompresses values after they are loaded
+    '''
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] != CACHE_VERSION:
+            self.conn.execute('DROP TABLE IF EXISTS kv')
+            self.conn.execute(f'PRAGMA user_version = {CACHE_VERSION}')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS kv(k TEXT PRIMARY KEY, v BLOB)')
+        self.conn.commit()
+        self.dirty = False
+        self.compressor = zstd.ZstdCompressor(level=3)
+        self.decompressor = zstd.ZstdDecompressor()
+
+    def __contains__(self, key):
+        row = self.conn.execute('SELECT 1 FROM kv WHERE k=?', (key,)).fetchone()
+        return row is not None
+
+    def __getitem__(self, key):
+        row = self.conn.execute('SELECT v FROM kv WHERE k=?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return orjson.loads(self.decompressor.decompress(row[0]))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO kv(k, v) VALUES (?, ?)',
+                          (key, self.compressor.compress(orjson.dumps(value))))
+        self.dirty = True
 
 def open_cache():
-    ''' opens the cache file if it exists and loads the JSON into
-    a dictionary, which it then returns.
-    if the cache file doesn't exist, creates a new cache dictionary
+    ''' opens the cache database, creating it if it doesn't exist
     Parameters
     ----------
     None
@@ -21,31 +114,33 @@ def open_cache():
     -------
     The opened cache
     '''
-    try:
-        cache_file = open(CACHE_FILENAME, 'r')
-        cache_contents = cache_file.read()
-        cache_dict = json.loads(cache_contents)
-        cache_file.close()
-    except:
-        cache_dict = {}
-    return cache_dict
-
-def save_cache(cache_dict):
-    ''' saves the current state of the cache to disk
+    return Cache(CACHE_FILENAME)
+
+def save_cache(cache):
+    ''' commits the pending writes of the cache to disk, if there are any
     Parameters
     ----------
-    cache_dict: dict
-        The dictionary to save
+    cache: Cache
+        The cache to save
     Returns
     -------
     None
     '''
-    dumped_json_cache = json.dumps(cache_dict)
-    fw = open(CACHE_FILENAME,"w")
-    fw.write(dumped_json_cache)
-    fw.close() 
+    if cache.dirty:
+        cache.conn.commit()
+        cache.dirty = False
 
 CACHE = open_cache()
+atexit.register(save_cache, CACHE)
+
+# national site instances already built this run, keyed by state URL
+_SITE_OBJ_CACHE = {}
+
+# when set (with --refresh), cached nps.gov pages are checked against the
+# site once per run with a conditional GET instead of being used as-is
+REFRESH = False
+# cache keys of the pages already refreshed this run
+_REFRESHED = set()
 
 class NationalSite:
     '''a national site
@@ -68,6 +163,8 @@ class NationalSite:
     phone: string
         the phone of a national site (e.g. '(616) 319-7906', '307-344-7381')
     '''
+    __slots__ = ('category', 'name', 'address', 'zipcode', 'phone')
+
     def __init__(self, category, name, address, zipcode, phone):
         self.category = category
         self.name = name
@@ -88,20 +185,283 @@ class NationalSite:
         '''
         return f"{self.name} ({self.category}): {self.address} {self.zipcode}"
 
-def json_to_NationalSite(json):
-    ''' Converts json dictionary to National Site object
+    def to_tuple(self):
+        ''' Tuple representation of a National Site object for the cache
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        tuple
+            (category, name, address, zipcode, phone)
+
+        '''
+        return (self.category, self.name, self.address, self.zipcode, self.phone)
+
+    @classmethod
+    def from_tuple(cls, t):
+        ''' Makes a National Site object from its tuple representation
+        Parameters
+        ----------
+        t: tuple or list
+            (category, name, address, zipcode, phone), as made by to_tuple
+
+        Returns
+        -------
+        National Site object
+
+        '''
+        return cls(*t)
+
+def run(async_function, *args):
+    ''' Run one of the async functions below to completion from synchronous code
+
+    Parameters
+    ----------
+    async_function: coroutine function
+        takes the shared client session as its first argument
+    *args
+        the rest of the arguments for async_function
+
+    Returns
+    -------
+    whatever async_function returns
+    '''
+    async def with_session():
+        global SESSION
+        if SESSION is None:
+            SESSION = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+                limit=MAX_CONNECTIONS, keepalive_timeout=60))
+        return await async_function(SESSION, *args)
+    return LOOP.run_until_complete(with_session())
+
+def close_session():
+    ''' Close the shared client session and the event loop
+    Parameters
+    ----------
+    None
+    Returns
+    -------
+    None
+    '''
+    if SESSION is not None:
+        LOOP.run_until_complete(SESSION.close())
+    LOOP.close()
+
+atexit.register(close_session)
+
+def use_cached(key):
+    ''' Whether the cached entry for a page can be used without asking nps.gov
+
+    Parameters
+    ----------
+    key: string
+        the cache key of the page
+
+    Returns
+    -------
+    bool
+        True if the page is cached and either REFRESH is off or the page
+        has already been refreshed during this run
+    '''
+    return key in CACHE and (not REFRESH or key in _REFRESHED)
+
+async def get_with_retries(session, url, headers=None):
+    ''' Request a url, retrying on connection errors
+
+    Parameters
+    ----------
+    session: aiohttp.ClientSession
+        the session to make the request with
+    url: string
+        the URL to request
+    headers: dict or None
+        extra request headers
+
+    Returns
+    -------
+    tuple
+        the response, with status 200 or 304, and its body
+
+    Raises
+    ------
+    aiohttp.ClientResponseError
+        if the server answers with an error status
+    aiohttp.ClientConnectionError
+        if the request still fails after MAX_RETRIES retries
+    '''
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status != 304:
+                    response.raise_for_status()
+                body = await response.read()
+            return response, body
+        except aiohttp.ClientConnectionError:
+            if attempt == MAX_RETRIES:
+                raise
+
+async def conditional_get(session, url, entry):
+    ''' Request a page, letting the server skip the body if it hasn't changed
+
+    Parameters
+    ----------
+    session: aiohttp.ClientSession
+        the session to make the request with
+    url: string
+        the URL of the page
+    entry: dict or None
+        the cached entry for the page, if there is one
+
+    Returns
+    -------
+    tuple
+        the response, with status 304 if entry is still current, and its body
+    '''
+    headers = {}
+    if entry is not None:
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+    return await get_with_retries(session, url, headers)
+
+def make_entry(data, response):
+    ''' Make a cache entry for data parsed from a page
+
+    Parameters
+    ----------
+    data
+        the data parsed from the page
+    response: aiohttp.ClientResponse
+        the response the page came from
+
+    Returns
+    -------
+    dict
+        the data together with the validators needed to refresh it later
+    '''
+    return {'data': data, 'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')}
+
+def store_entry(key, entry):
+    ''' Save a page entry in the cache and mark it as refreshed for this run
 
     Parameters
     ----------
-    json
-        json dictionary with keys corresponding to National Site object attributes
+    key: string
+        the cache key of the page
+    entry: dict
+        the entry made by make_entry
 
     Returns
     -------
-    National Site object
+    None
+    '''
+    CACHE[key] = entry
+    _REFRESHED.add(key)
+
+def parse_state_index(html):
+    ''' Parse the nps.gov index page into a dictionary of state page urls
+
+    Parameters
+    ----------
+    html: bytes
+        the index page
 
+    Returns
+    -------
+    dict
+        key is a state name and value is the url
+
+    Raises
+    ------
+    ValueError
+        if the page has no list of states, e.g. an error page
     '''
-    return NationalSite(json['category'], json['name'], json['address'], json['zipcode'], json['phone'])
+    state_dict = {}
+    tree = lxml.html.fromstring(html)
+    items = STATE_LINKS_XPATH(tree)
+    if not items:
+        raise ValueError("no list of states on the nps.gov index page")
+    for item in items:
+        state_dict[item.text_content().strip().lower()] = 'https://www.nps.gov' + item.get('href')
+    return state_dict
+
+def parse_state_page(html):
+    ''' Parse a state page into the list of its national site urls
+
+    Parameters
+    ----------
+    html: bytes
+        the state page
+
+    Returns
+    -------
+    list
+        the urls of the national site pages
+
+    Raises
+    ------
+    ValueError
+        if the page has no list of sites, e.g. an error page
+    '''
+    soup = BeautifulSoup(html, 'lxml', parse_only=PARK_LIST_STRAINER)
+    sites = soup.find(id='parkListResultsArea')
+    if sites is None:
+        raise ValueError("no list of sites on the state page")
+    headers = sites.find_all('h3')
+    return ['https://www.nps.gov' + header.find('a')['href'] + 'index.htm' for header in headers]
+
+def parse_site_page(html):
+    ''' Parse a national site page
+
+    Parameters
+    ----------
+    html: bytes
+        the national site page
+
+    Returns
+    -------
+    tuple
+        the national site in the form made by NationalSite.to_tuple
+    '''
+    tree = lxml.html.fromstring(html)
+    category = CATEGORY_XPATH(tree)[0]
+    name = NAME_XPATH(tree)[0]
+    city = CITY_XPATH(tree)[0].strip()
+    state = STATE_XPATH(tree)[0].strip()
+    address = city + ', ' + state
+    zipcode = ZIPCODE_XPATH(tree)[0].strip()
+    phone = PHONE_XPATH(tree)[0].strip()
+    return (category, name, address, zipcode, phone)
+
+async def build_state_url_dict_async(session):
+    ''' Async version of build_state_url_dict
+
+    Parameters
+    ----------
+    session: aiohttp.ClientSession
+        the session to make requests with
+
+    Returns
+    -------
+    dict
+        key is a state name and value is the url
+    '''
+    if use_cached('states'):
+        print("Using cache")
+        return CACHE['states']['data']
+    else:
+        print("Fetching")
+        entry = CACHE.get('states')
+        response, html = await conditional_get(session, 'https://www.nps.gov/index.htm', entry)
+        if response.status != 304:
+            state_dict = await asyncio.to_thread(parse_state_index, html)
+            entry = make_entry(state_dict, response)
+        store_entry('states', entry)
+        return entry['data']
 
 def build_state_url_dict():
     ''' Make a dictionary that maps state name to state page url from "https://www.nps.gov"
@@ -116,21 +476,57 @@ def build_state_url_dict():
         key is a state name and value is the url
         e.g. {'michigan':'https://www.nps.gov/state/mi/index.htm', ...}
     '''
-    if 'states' in CACHE:
+    return run(build_state_url_dict_async)
+
+async def fetch_site_entry(session, site_url, entry=None):
+    '''Fetch and parse a national site page, without using the cache.
+
+    Parsing runs in a worker thread so other fetches can continue.
+
+    Parameters
+    ----------
+    session: aiohttp.ClientSession
+        the session to make the request with
+    site_url: string
+        The URL for a national site page in nps.gov
+    entry: dict or None
+        The cached entry for the page. If given, the page is only
+        downloaded and parsed again if it has changed.
+
+    Returns
+    -------
+    dict
+        the cache entry for the page, its data is the national site
+        in the form made by NationalSite.to_tuple
+    '''
+    print("Fetching")
+    response, html = await conditional_get(session, site_url, entry)
+    if response.status == 304:
+        return entry
+    return make_entry(await asyncio.to_thread(parse_site_page, html), response)
+
+async def get_site_instance_async(session, site_url):
+    '''Async version of get_site_instance
+
+    Parameters
+    ----------
+    session: aiohttp.ClientSession
+        the session to make requests with
+    site_url: string
+        The URL for a national site page in nps.gov
+
+    Returns
+    -------
+    instance
+        a national site instance
+    '''
+    if use_cached(site_url):
         print("Using cache")
-        return CACHE['states']
+        return NationalSite.from_tuple(CACHE[site_url]['data'])
     else:
-        print("Fetching")
-        state_dict = {}
-        html = requests.get('https://www.nps.gov/index.htm').text
-        soup = BeautifulSoup(html, 'html.parser')
-        state_list = soup.find_all('ul', class_= "dropdown-menu SearchBar-keywordSearch")
-        list_items = state_list[0].find_all('a')
-        for item in list_items:
-            state_dict[item.text.strip().lower()] = 'https://www.nps.gov' + item['href']
-        CACHE['states'] = state_dict
-        save_cache(CACHE)
-        return state_dict
+        entry = await fetch_site_entry(session, site_url, CACHE.get(site_url))
+        store_entry(site_url, entry)
+        return NationalSite.from_tuple(entry['data'])
 
 def get_site_instance(site_url):
     '''Make an instances from a national site URL.
@@ -145,30 +541,68 @@ def get_site_instance(site_url):
     instance
         a national site instance
     '''
-    if site_url in CACHE:
+    return run(get_site_instance_async, site_url)
+
+
+async def get_sites_for_state_async(session, state_url):
+    '''Async version of get_sites_for_state
+
+    Parameters
+    ----------
+    session: aiohttp.ClientSession
+        the session to make requests with
+    state_url: string
+        The URL for a state page in nps.gov
+
+    Returns
+    -------
+    list
+        a list of national site instances
+    '''
+    if state_url in _SITE_OBJ_CACHE:
+        print("Using cache")
+        return _SITE_OBJ_CACHE[state_url]
+    if use_cached(state_url):
         print("Using cache")
-        return json_to_NationalSite(CACHE[site_url])
+        site_urls = CACHE[state_url]['data']
     else:
         print("Fetching")
-        html = requests.get(site_url).text
-        soup = BeautifulSoup(html, 'html.parser')
-        div_category = soup.find(class_="Hero-designationContainer")
-        category = div_category.find('span', class_="Hero-designation").contents[0]
-        div_name = soup.find(class_="Hero-titleContainer clearfix")
-        name = div_name.find('a').contents[0]
-        city = soup.find('span', itemprop="addressLocality").contents[0].strip()
-        state = soup.find('span', itemprop="addressRegion").contents[0].strip()
-        address = city + ', ' + state
-        zipcode = soup.find('span', itemprop="postalCode").contents[0].strip()
-        phone = soup.find('span', itemprop="telephone").contents[0].strip()
-        instance = NationalSite(category, name, address, zipcode, phone)
-        CACHE[site_url] = instance.__dict__
+        entry = CACHE.get(state_url)
+        response, html = await conditional_get(session, state_url, entry)
+        if response.status != 304:
+            entry = make_entry(await asyncio.to_thread(parse_state_page, html), response)
+        store_entry(state_url, entry)
+        site_urls = entry['data']
+    # one lookup per site; the freshness rule is the one in use_cached
+    site_entries = {url: CACHE.get(url) for url in dict.fromkeys(site_urls)}
+    stale_urls = [url for url, site_entry in site_entries.items()
+                  if site_entry is None or (REFRESH and url not in _REFRESHED)]
+    # keep every site that was fetched even if another one failed
+    fetched_entries = await asyncio.gather(*[fetch_site_entry(session, url, site_entries[url])
+                                             for url in stale_urls], return_exceptions=True)
+    error = None
+    for url, site_entry in zip(stale_urls, fetched_entries):
+        if isinstance(site_entry, BaseException):
+            error = error or site_entry
+        else:
+            store_entry(url, site_entry)
+            site_entries[url] = site_entry
+    if error is not None:
         save_cache(CACHE)
-        return instance
-
+        raise error
+    site_instances = [NationalSite.from_tuple(site_entries[url]['data']) for url in site_urls]
+    save_cache(CACHE)
+    _SITE_OBJ_CACHE[state_url] = site_instances
+    return site_instances
 
 def get_sites_for_state(state_url):
     '''Make a list of national site instances from a state URL.
+
+    The cache keeps the list of site URLs for a state separately from the
+    sites themselves, so the state page is only needed to find the URLs.
+    Site pages that are not cached yet are fetched concurrently. The list
+    is kept in memory, so asking for the same state again returns it
+    without rebuilding the instances.
     
     Parameters
     ----------
@@ -180,26 +614,51 @@ def get_sites_for_state(state_url):
     list
         a list of national site instances
     '''
-    site_instances = []
-    if state_url in CACHE:
+    return run(get_sites_for_state_async, state_url)
+
+async def fetch_nearby_async(session, zipcode):
+    '''Obtain API data from MapQuest API for a zipcode.
+
+    Parameters
+    ----------
+    session: aiohttp.ClientSession
+        the session to make the request with
+    zipcode: string
+        the zipcode to search around
+
+    Returns
+    -------
+    dict
+        a converted API return from MapQuest API
+    '''
+    if zipcode in CACHE:
         print("Using cache")
-        for site in CACHE[state_url]:
-            site_instances.append(json_to_NationalSite(site))
+        return CACHE[zipcode]
     else:
         print("Fetching")
-        site_instances_cache = []
-        html = requests.get(state_url).text
-        soup = BeautifulSoup(html, 'html.parser')
-        sites = soup.find(id = 'parkListResultsArea')
-        headers = sites.find_all('h3')
-        for header in headers:
-            url = header.find('a')
-            instance = get_site_instance('https://www.nps.gov' + url['href'] + 'index.htm')
-            site_instances.append(instance)
-            site_instances_cache.append(instance.__dict__)
-        CACHE[state_url] = site_instances_cache
-        save_cache(CACHE)
-    return site_instances
+        BASE_URL = f'http://www.mapquestapi.com/search/v2/radius?key={secrets.API_KEY}&radius=10&maxMatches=10&ambiguities=ignore&origin='
+        response, body = await get_with_retries(session, BASE_URL + f'{zipcode}')
+        results = orjson.loads(body)
+        CACHE[zipcode] = results
+        return results
+
+@functools.lru_cache(maxsize=1024)
+def _fetch_nearby(zipcode):
+    '''Obtain API data from MapQuest API for a zipcode.
+
+    Results are kept in memory for the rest of the run, in front of CACHE.
+
+    Parameters
+    ----------
+    zipcode: string
+        the zipcode to search around
+
+    Returns
+    -------
+    dict
+        a converted API return from MapQuest API
+    '''
+    return run(fetch_nearby_async, zipcode)
 
 def get_nearby_places(site_object):
     '''Obtain API data from MapQuest API.
@@ -214,17 +673,7 @@ def get_nearby_places(site_object):
     dict
         a converted API return from MapQuest API
     '''
-    if site_object.zipcode in CACHE:
-        print("Using cache")
-        return CACHE[site_object.zipcode]
-    else:
-        print("Fetching")
-        BASE_URL = f'http://www.mapquestapi.com/search/v2/radius?key={secrets.API_KEY}&radius=10&maxMatches=10&ambiguities=ignore&origin='
-        response = requests.get(BASE_URL + f'{site_object.zipcode}')
-        results = response.json()
-        CACHE[site_object.zipcode] = results
-        save_cache(CACHE)
-        return results
+    return _fetch_nearby(site_object.zipcode)
 
 def nearby_places_info(place_dict):
     ''' Returns description of a place
@@ -240,28 +689,17 @@ def nearby_places_info(place_dict):
         Description of place
     '''
     name = place_dict["name"]
-
-    if not place_dict['group_sic_code_name_ext']:
-        category = 'no category'
-    else:
-        category = place_dict['group_sic_code_name_ext']
-
-    if not place_dict['address']:
-        address = 'no address'
-    else:
-        address = place_dict['address']
-
-    if not place_dict['city']:
-        city = 'no city'
-    else:
-        city = place_dict['city']
+    category = place_dict.get('group_sic_code_name_ext') or 'no category'
+    address = place_dict.get('address') or 'no address'
+    city = place_dict.get('city') or 'no city'
 
     return f"{name} ({category}): {address}, {city}"
 
 if __name__ == "__main__":
+    REFRESH = '--refresh' in sys.argv[1:]
     states = build_state_url_dict()
     while True:
-        inp = input('Enter a state name (e.g. Michigan, michigan) or "exit": ').lower()
+        inp = input('Enter a state name (e.g. Michigan, michigan) or "exit": ').strip().lower()
         if inp in states:
             sites = get_sites_for_state(states[inp])
             print("------------------------------------")
@@ -273,12 +711,14 @@ if __name__ == "__main__":
                 count += 1
             while True:
                 print("\n------------------------------------")
-                inp = input('Choose the number for detailed search or "exit" or "back": ').lower()
+                inp = input('Choose the number for detailed search or "exit" or "back": ').strip().lower()
                 if inp.isnumeric():
-                    if int(inp) in range (1, count+1):
-                        places = get_nearby_places(sites[int(inp)-1])
+                    n = int(inp)
+                    if 1 <= n <= len(sites):
+                        site = sites[n-1]
+                        places = get_nearby_places(site)
                         print("------------------------------------")
-                        print(f"Places near {sites[int(inp)-1].name}")
+                        print(f"Places near {site.name}")
                         print("------------------------------------")
                         count1 = 1
                         for place in places["searchResults"]:
@@ -1,9 +1,34 @@
+import asyncio
+import os
+import tempfile
+import types
 import unittest
+from unittest import mock
 import proj2_nps as nps
 
 # SI 507 Fall 2020
 # Project 2
 
+# small pages shaped like nps.gov's, for the tests that run offline
+INDEX_PAGE = b'''<html><body><ul class="dropdown-menu SearchBar-keywordSearch">
+<li><a href="/state/mi/index.htm"> Michigan </a></li>
+<li><a href="/state/wy/index.htm">Wyoming</a></li></ul></body></html>'''
+
+STATE_PAGE = b'''<html><body><h3>Featured</h3><div id="parkListResultsArea"><ul>
+<li><h3><a href="/bica/">Bighorn Canyon</a></h3></li>
+<li><h3><a href="/yell/">Yellowstone</a></h3></li></ul></div></body></html>'''
+
+SITE_PAGE = b'''<html><body>
+<div class="Hero-designationContainer"><span class="Hero-designation">National Park</span></div>
+<div class="Hero-titleContainer clearfix"><a href="/yell/">Yellowstone</a></div>
+<span itemprop="addressLocality"> Yellowstone National Park </span>,
+<span itemprop="addressRegion">WY</span> <span itemprop="postalCode"> 82190-0168 </span>
+<span itemprop="telephone">
+307-344-7381
+</span></body></html>'''
+
+ERROR_PAGE = b'<html><body><h1>503 Service Unavailable</h1></body></html>'
+
 class Test_Part1(unittest.TestCase):
     def setUp(self):
         self.state_url = nps.build_state_url_dict()
@@ -44,6 +69,11 @@ class Test_Part2(unittest.TestCase):
         self.assertEqual(self.site_mi1.info(), "North Country (National Scenic Trail): Lowell, MI 49331")
         self.assertEqual(self.site_wy1.info(), "Yellowstone (National Park): Yellowstone National Park, WY 82190-0168")
 
+    def test_2_5_tuple(self):
+        self.assertEqual(self.site_wy1.to_tuple(), ("National Park", "Yellowstone",
+            "Yellowstone National Park, WY", "82190-0168", "307-344-7381"))
+        self.assertEqual(nps.NationalSite.from_tuple(self.site_wy1.to_tuple()).info(), self.site_wy1.info())
+
 
 class Test_Part3(unittest.TestCase):
     def setUp(self):
@@ -84,5 +114,145 @@ class Test_Part4(unittest.TestCase):
         self.assertEqual(self.near_wy['options']['radius'], 10)
 
 
+class Test_Cache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'cache.db')
+        self.cache = nps.Cache(self.filename)
+
+    def tearDown(self):
+        self.cache.conn.close()
+        self.tmpdir.cleanup()
+
+    def test_5_1_round_trip(self):
+        self.assertNotIn('michigan', self.cache)
+        self.cache['michigan'] = {'name': 'Isle Royale', 'zipcode': '49931'}
+        self.assertIn('michigan', self.cache)
+        self.assertEqual(self.cache['michigan'], {'name': 'Isle Royale', 'zipcode': '49931'})
+        with self.assertRaises(KeyError):
+            self.cache['wyoming']
+
+    def test_5_2_saved_to_disk(self):
+        self.cache['49931'] = [1, 2, 3]
+        nps.save_cache(self.cache)
+        reopened = nps.Cache(self.filename)
+        self.assertEqual(reopened['49931'], [1, 2, 3])
+        reopened.conn.close()
+
+
+class Test_PlaceInfo(unittest.TestCase):
+    def test_6_1_full(self):
+        place = {'name': 'Lovell Inn', 'group_sic_code_name_ext': 'Hotels & Motels',
+                 'address': '1 Main St', 'city': 'Lovell'}
+        self.assertEqual(nps.nearby_places_info(place), "Lovell Inn (Hotels & Motels): 1 Main St, Lovell")
+
+    def test_6_2_missing_fields(self):
+        place = {'name': 'Lovell Inn', 'group_sic_code_name_ext': '', 'address': ''}
+        self.assertEqual(nps.nearby_places_info(place), "Lovell Inn (no category): no address, no city")
+
+
+class Test_Parse(unittest.TestCase):
+    def test_7_1_state_index(self):
+        self.assertEqual(nps.parse_state_index(INDEX_PAGE),
+                         {'michigan': 'https://www.nps.gov/state/mi/index.htm',
+                          'wyoming': 'https://www.nps.gov/state/wy/index.htm'})
+
+    def test_7_2_state_page(self):
+        self.assertEqual(nps.parse_state_page(STATE_PAGE),
+                         ['https://www.nps.gov/bica/index.htm', 'https://www.nps.gov/yell/index.htm'])
+
+    def test_7_3_site_page(self):
+        self.assertEqual(nps.parse_site_page(SITE_PAGE), ("National Park", "Yellowstone",
+            "Yellowstone National Park, WY", "82190-0168", "307-344-7381"))
+
+    def test_7_4_error_page(self):
+        with self.assertRaises(ValueError):
+            nps.parse_state_index(ERROR_PAGE)
+        with self.assertRaises(ValueError):
+            nps.parse_state_page(ERROR_PAGE)
+        with self.assertRaises(IndexError):
+            nps.parse_site_page(ERROR_PAGE)
+
+
+class Test_Fetch(unittest.TestCase):
+    ''' runs the fetch functions against a stubbed conditional_get and a fresh cache '''
+    PAGES = {
+        'https://www.nps.gov/state/wy/index.htm': STATE_PAGE,
+        'https://www.nps.gov/bica/index.htm': SITE_PAGE.replace(b'Yellowstone', b'Bighorn Canyon'),
+        'https://www.nps.gov/yell/index.htm': SITE_PAGE,
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = nps.Cache(os.path.join(self.tmpdir.name, 'cache.db'))
+        self.requests = []
+        for name, value in [('CACHE', self.cache), ('REFRESH', False), ('_REFRESHED', set()),
+                            ('_SITE_OBJ_CACHE', {}), ('conditional_get', self.conditional_get)]:
+            patcher = mock.patch.object(nps, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.cache.conn.close()
+        self.tmpdir.cleanup()
+
+    async def conditional_get(self, session, url, entry):
+        if entry is not None and entry['etag'] == '"v1"':
+            status, body = 304, b''
+        else:
+            status, body = 200, self.PAGES[url]
+        self.requests.append((url, status))
+        return types.SimpleNamespace(status=status, headers={'ETag': '"v1"'}), body
+
+    def test_8_1_cached(self):
+        url = 'https://www.nps.gov/yell/index.htm'
+        first = asyncio.run(nps.get_site_instance_async(None, url))
+        second = asyncio.run(nps.get_site_instance_async(None, url))
+        self.assertEqual(self.requests, [(url, 200)])
+        self.assertEqual(second.info(), first.info())
+        self.assertEqual(self.cache[url]['etag'], '"v1"')
+
+    def test_8_2_refresh_not_modified(self):
+        url = 'https://www.nps.gov/yell/index.htm'
+        asyncio.run(nps.get_site_instance_async(None, url))
+        nps._REFRESHED.clear()
+        with mock.patch.object(nps, 'REFRESH', True):
+            refreshed = asyncio.run(nps.get_site_instance_async(None, url))
+            asyncio.run(nps.get_site_instance_async(None, url))
+        # refreshed once per run, and the 304 reuses the cached data
+        self.assertEqual(self.requests, [(url, 200), (url, 304)])
+        self.assertEqual(refreshed.name, "Yellowstone")
+        self.assertEqual(self.cache[url]['data'][1], "Yellowstone")
+
+    def test_8_3_state_urls(self):
+        state_url = 'https://www.nps.gov/state/wy/index.htm'
+        sites = asyncio.run(nps.get_sites_for_state_async(None, state_url))
+        self.assertEqual([site.name for site in sites], ["Bighorn Canyon", "Yellowstone"])
+        self.assertEqual(self.cache[state_url]['data'],
+                         ['https://www.nps.gov/bica/index.htm', 'https://www.nps.gov/yell/index.htm'])
+        self.assertEqual(self.cache['https://www.nps.gov/bica/index.htm']['data'][1], "Bighorn Canyon")
+
+    def test_8_4_missing_site(self):
+        state_url = 'https://www.nps.gov/state/wy/index.htm'
+        asyncio.run(nps.get_sites_for_state_async(None, state_url))
+        self.cache.conn.execute('DELETE FROM kv WHERE k=?', ('https://www.nps.gov/bica/index.htm',))
+        nps._SITE_OBJ_CACHE.clear()
+        self.requests.clear()
+        sites = asyncio.run(nps.get_sites_for_state_async(None, state_url))
+        # only the missing site is fetched, the state page's URL list is reused
+        self.assertEqual(self.requests, [('https://www.nps.gov/bica/index.htm', 200)])
+        self.assertEqual(len(sites), 2)
+
+    def test_8_5_failed_site(self):
+        state_url = 'https://www.nps.gov/state/wy/index.htm'
+        with mock.patch.dict(self.PAGES, {'https://www.nps.gov/bica/index.htm': ERROR_PAGE}):
+            with self.assertRaises(IndexError):
+                asyncio.run(nps.get_sites_for_state_async(None, state_url))
+        # the site that did load is kept, the broken one is not cached
+        self.assertIn('https://www.nps.gov/yell/index.htm', self.cache)
+        self.assertNotIn('https://www.nps.gov/bica/index.htm', self.cache)
+        self.assertNotIn(state_url, nps._SITE_OBJ_CACHE)
+
+
 if __name__ == '__main__':
     unittest.main()